@@ -1,9 +1,15 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 import datetime
-from sql import Null
-from sql.conditionals import Coalesce
+from collections import defaultdict
+from weakref import WeakKeyDictionary
+from sql import For, Literal, Null, Window
+from sql.aggregate import Max
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp
 
+from trytond import backend
+from trytond.cache import LRUDictTransaction
 from trytond.model import fields, ModelSQL, ModelView, Workflow
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval, If, Bool
@@ -29,6 +35,32 @@ class SubscriptionService(metaclass=PoolMeta):
         filter=[
             ('subscribed', '=', None),
             ])
+    has_asset_lots = fields.Boolean("Has Asset Lots", readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        pool = Pool()
+        ServiceLot = pool.get('sale.subscription.service-stock.lot.asset')
+        cursor = Transaction().connection.cursor()
+        sql_table = cls.__table__()
+        service_lot = ServiceLot.__table__()
+
+        table = TableHandler(cls, module_name)
+        has_asset_lots_exist = table.column_exist('has_asset_lots')
+
+        super(SubscriptionService, cls).__register__(module_name)
+
+        # Migration from 4.8: fill has_asset_lots
+        if not has_asset_lots_exist:
+            cursor.execute(*sql_table.update(
+                    [sql_table.has_asset_lots], [True],
+                    where=sql_table.id.in_(
+                        service_lot.select(service_lot.service))))
+
+    @staticmethod
+    def default_has_asset_lots():
+        return False
 
 
 class SubscriptionServiceStockLot(ModelSQL):
@@ -44,6 +76,55 @@ class SubscriptionServiceStockLot(ModelSQL):
             ('product.type', '=', 'assets'),
             ])
 
+    @classmethod
+    def create(cls, vlist):
+        records = super(SubscriptionServiceStockLot, cls).create(vlist)
+        cls._update_has_asset_lots({r.service.id for r in records})
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        service_ids = set()
+        for records, values in zip(actions, actions):
+            if 'service' in values:
+                service_ids.update(r.service.id for r in records)
+                service_ids.add(values['service'])
+        super(SubscriptionServiceStockLot, cls).write(*args)
+        cls._update_has_asset_lots(service_ids)
+
+    @classmethod
+    def delete(cls, records):
+        service_ids = {r.service.id for r in records}
+        super(SubscriptionServiceStockLot, cls).delete(records)
+        cls._update_has_asset_lots(service_ids)
+
+    @classmethod
+    def _update_has_asset_lots(cls, service_ids):
+        "Set has_asset_lots of the services from their asset lots"
+        if not service_ids:
+            return
+
+        pool = Pool()
+        Service = pool.get('sale.subscription.service')
+        service = Service.__table__()
+        service_lot = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        for sub_ids in grouped_slice(list(service_ids)):
+            sub_ids = list(sub_ids)
+            cursor.execute(*service.update(
+                    [service.has_asset_lots],
+                    [service.id.in_(service_lot.select(service_lot.service,
+                                where=reduce_ids(
+                                    service_lot.service, sub_ids)))],
+                    where=reduce_ids(service.id, sub_ids)))
+        # Clean the cache of the updated services
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            cache.pop(Service.__name__, None)
+
 
 class Subscription(metaclass=PoolMeta):
     __name__ = 'sale.subscription'
@@ -62,9 +143,21 @@ class Subscription(metaclass=PoolMeta):
     def cancel(cls, subscriptions):
         pool = Pool()
         SubscriptionLine = pool.get('sale.subscription.line')
+        line = SubscriptionLine.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
 
-        sub_lines = [l for s in subscriptions for l in s.lines if l.asset_lot]
-        SubscriptionLine.write(sub_lines, {'asset_lot': None})
+        for sub_subscriptions in grouped_slice(subscriptions):
+            sub_ids = [s.id for s in sub_subscriptions]
+            cursor.execute(*line.update(
+                    columns=[line.asset_lot, line.write_uid, line.write_date],
+                    values=[Null, transaction.user, CurrentTimestamp()],
+                    where=reduce_ids(line.subscription, sub_ids)
+                    & (line.asset_lot != Null)))
+        # Clean the cache of the updated lines
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            cache.pop(SubscriptionLine.__name__, None)
 
         super(Subscription, cls).cancel(subscriptions)
 
@@ -75,7 +168,9 @@ class Subscription(metaclass=PoolMeta):
         pool = Pool()
         Line = pool.get('sale.subscription.line')
         super(Subscription, cls).run(subscriptions)
-        lines = [l for s in subscriptions for l in s.lines]
+        lines = Line.search([
+                ('subscription', 'in', [s.id for s in subscriptions]),
+                ])
         Line._validate(lines, ['asset_lot'])
 
 
@@ -125,6 +220,8 @@ class SubscriptionLine(metaclass=PoolMeta):
     asset_lot_required = fields.Function(
         fields.Boolean("Asset Lot Required"),
         'on_change_with_asset_lot_required')
+    # Consumption rrulesets per transaction
+    _consumption_rrulesets = WeakKeyDictionary()
 
     @classmethod
     def __setup__(cls):
@@ -144,6 +241,39 @@ class SubscriptionLine(metaclass=PoolMeta):
                     'for the same lot overlap.'),
                 })
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        super(SubscriptionLine, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        if backend.name() == 'postgresql':
+            # Index the end date as coalesced by the overlap check
+            table.index_action(
+                ['asset_lot', 'start_date', 'end_date'], 'remove')
+            index_name = cls._table + '_asset_lot_dates_index'
+            if index_name not in table._indexes:
+                cursor.execute('CREATE INDEX "' + index_name + '" '
+                    'ON "' + cls._table + '" ("asset_lot", "start_date", '
+                    'COALESCE("end_date", %s))', (datetime.date.max,))
+            # Lines are mostly created in chronological order so BRIN
+            # indexes (available since PostgreSQL 9.5) fit the dates
+            if transaction.database.get_version(
+                    transaction.connection) >= (9, 5):
+                for column in ['start_date', 'end_date']:
+                    index_name = cls._table + '_' + column + '_brin_index'
+                    if index_name in table._indexes:
+                        continue
+                    cursor.execute('CREATE INDEX "' + index_name + '" '
+                        'ON "' + cls._table + '" '
+                        'USING BRIN ("' + column + '") '
+                        'WITH (pages_per_range = 32)')
+        else:
+            table.index_action(['asset_lot', 'start_date', 'end_date'], 'add')
+
     @fields.depends('subscription', 'start_date', 'end_date',
         '_parent_subscription.start_date', '_parent_subscription.end_date')
     def on_change_subscription(self):
@@ -155,13 +285,17 @@ class SubscriptionLine(metaclass=PoolMeta):
 
     def _get_context_sale_price(self):
         context = {}
-        if getattr(self, 'subscription', None):
-            if getattr(self.subscription, 'currency', None):
-                context['currency'] = self.subscription.currency.id
-            if getattr(self.subscription, 'party', None):
-                context['customer'] = self.subscription.party.id
-            if getattr(self.subscription, 'start_date'):
-                context['sale_date'] = self.subscription.start_date
+        subscription = getattr(self, 'subscription', None)
+        if subscription:
+            currency = getattr(subscription, 'currency', None)
+            if currency:
+                context['currency'] = currency.id
+            party = getattr(subscription, 'party', None)
+            if party:
+                context['customer'] = party.id
+            start_date = getattr(subscription, 'start_date')
+            if start_date:
+                context['sale_date'] = start_date
         if self.unit:
             context['uom'] = self.unit.id
         elif self.service:
@@ -173,29 +307,46 @@ class SubscriptionLine(metaclass=PoolMeta):
         if not self.consumption_recurrence:
             return None
         date = self.next_consumption_date or self.start_date
-        rruleset = self.consumption_recurrence.rruleset(self.start_date)
+        rruleset = self._get_consumption_rruleset()
         dt = datetime.datetime.combine(date, datetime.time())
         inc = (self.start_date == date) and not self.next_consumption_date
         next_date = rruleset.after(dt, inc=inc).date()
-        for end_date in [self.end_date, self.subscription.end_date]:
-            if end_date:
-                if next_date > end_date:
-                    return None
+        if self.end_date and next_date > self.end_date:
+            return None
+        end_date = self.subscription.end_date
+        if end_date and next_date > end_date:
+            return None
         return next_date
 
+    def _get_consumption_rruleset(self):
+        "Return the consumption rruleset shared by lines of the transaction"
+        recurrence = self.consumption_recurrence
+        if recurrence.id is None or recurrence.id < 0:
+            return recurrence.rruleset(self.start_date)
+        transaction = Transaction()
+        cache = self._consumption_rrulesets.get(transaction)
+        if cache is None:
+            cache = self._consumption_rrulesets[transaction] = (
+                LRUDictTransaction(1024))
+        # Drop the rulesets if anything was written since they were built
+        cache.refresh()
+        rruleset_key = (recurrence.id, self.start_date)
+        if rruleset_key not in cache:
+            cache[rruleset_key] = recurrence.rruleset(self.start_date)
+        return cache[rruleset_key]
+
     @fields.depends('service')
     def on_change_with_asset_lot_required(self, name=None):
         if not self.service:
             return False
-        return bool(self.service.asset_lots)
+        return bool(self.service.has_asset_lots)
 
     @classmethod
     def copy(cls, lines, default=None):
         if default is None:
-            default = {}
-        else:
-            default = default.copy()
-        default.setdefault('lot')
+            default = {'lot': None}
+        elif 'lot' not in default:
+            default = dict(default, lot=None)
         return super(SubscriptionLine, cls).copy(lines, default)
 
     @classmethod
@@ -209,37 +360,113 @@ class SubscriptionLine(metaclass=PoolMeta):
         connection = transaction.connection
         cursor = connection.cursor()
 
-        transaction.database.lock(connection, cls._table)
+        lines = [l for l in lines if l.asset_lot]
+        if not lines:
+            return
+
+        ids = {l.id for l in lines}
+        lot2ids = defaultdict(list)
+        for l in lines:
+            lot2ids[l.asset_lot.id].append(l.id)
+        lot_ids = sorted(lot2ids)
+
+        # Lock only the lots of the lines instead of the whole table
+        if transaction.database.has_select_for():
+            pool = Pool()
+            Lot = pool.get('stock.lot')
+            lot = Lot.__table__()
+            for sub_lot_ids in grouped_slice(lot_ids):
+                cursor.execute(*lot.select(Literal(1),
+                        where=reduce_ids(lot.id, sub_lot_ids),
+                        for_=For('UPDATE', nowait=True)))
+        else:
+            transaction.database.lock(connection, cls._table)
 
         line = cls.__table__()
         other = cls.__table__()
-        overlap_where = (
-            ((line.end_date == Null)
-                & ((other.end_date == Null)
-                    | (other.start_date > line.start_date)
-                    | (other.end_date > line.start_date)))
-            | ((line.end_date != Null)
-                & (((other.end_date == Null)
-                        & (other.start_date < line.end_date))
-                    | ((other.end_date != Null)
-                        & (((other.end_date >= line.start_date)
-                                & (other.end_date < line.end_date))
-                            | ((other.start_date >= line.start_date)
-                                & (other.start_date < line.end_date)))))))
-        for sub_lines in grouped_slice(lines):
-            sub_ids = [l.id for l in sub_lines]
-            cursor.execute(*line.join(other,
-                    condition=((line.id != other.id)
-                        & (line.asset_lot == other.asset_lot))
-                    ).select(line.id, other.id,
-                    where=((line.asset_lot != Null)
-                        & reduce_ids(line.id, sub_ids)
-                        & overlap_where),
-                    limit=1))
-            overlapping = cursor.fetchone()
+        end_date = Coalesce(line.end_date, datetime.date.max)
+        # All the lines of the lot sorted before the current one
+        window = Window([line.asset_lot],
+            order_by=[line.start_date.asc, line.id.asc],
+            frame='ROWS', start=None, end=-1)
+        for sub_lot_ids in grouped_slice(lot_ids):
+            sub_lot_ids = list(sub_lot_ids)
+            if transaction.database.has_window_functions():
+                sub_ids = [i for l in sub_lot_ids for i in lot2ids[l]]
+                # Same check as _sweep_overlapping_dates: a line overlaps a
+                # line sorted before it if it starts before their latest end
+                # date, considering only the validated lines when it is not
+                # validated itself. Lines ending on their start date are
+                # skipped as they do not hold the lot.
+                validated = reduce_ids(line.id, sub_ids)
+                query = line.select(
+                    line.id.as_('id'),
+                    line.asset_lot.as_('asset_lot'),
+                    line.start_date.as_('start_date'),
+                    Max(end_date, window=window).as_('max_end_date'),
+                    Max(Case((validated, end_date)), window=window
+                        ).as_('validated_end_date'),
+                    where=(reduce_ids(line.asset_lot, sub_lot_ids)
+                        & (line.start_date < end_date)))
+                cursor.execute(*query.select(
+                        query.id, query.asset_lot, query.start_date,
+                        where=((reduce_ids(query.id, sub_ids)
+                                & (query.start_date < query.max_end_date))
+                            | (query.start_date < query.validated_end_date)),
+                        limit=1))
+                overlapping = cursor.fetchone()
+                if overlapping:
+                    line_id, lot_id, start_date = overlapping
+                    where = ((other.asset_lot == lot_id)
+                        & (other.id != line_id)
+                        & (other.start_date <= start_date)
+                        & (Coalesce(other.end_date, datetime.date.max)
+                            > start_date))
+                    if line_id not in ids:
+                        where &= reduce_ids(other.id, sub_ids)
+                    cursor.execute(*other.select(other.id,
+                            where=where, limit=1))
+                    other_id, = cursor.fetchone()
+                    overlapping = other_id, line_id
+            else:
+                cursor.execute(*line.select(
+                        line.id, line.asset_lot, line.start_date,
+                        line.end_date,
+                        where=reduce_ids(line.asset_lot, sub_lot_ids),
+                        order_by=[line.asset_lot, line.start_date, line.id]))
+                overlapping = cls._sweep_overlapping_dates(cursor, ids)
             if overlapping:
                 sline1, sline2 = cls.browse(overlapping)
                 cls.raise_user_error('asset_overlapping_dates', {
                         'line1': sline1.rec_name,
                         'line2': sline2.rec_name,
                         })
+
+    @staticmethod
+    def _sweep_overlapping_dates(rows, ids):
+        """Return the first pair of overlapping lines involving ids
+
+        rows must be tuples of (id, asset_lot, start_date, end_date) ordered
+        by asset_lot and start_date. A single pass keeps for each lot the
+        latest end date seen so far (for all the lines and for those in ids).
+        Lines ending on their start date do not hold the lot and are skipped.
+        """
+        lot = None
+        for line_id, line_lot, start_date, end_date in rows:
+            if end_date is None:
+                end_date = datetime.date.max
+            elif end_date <= start_date:
+                continue
+            if line_lot != lot:
+                lot = line_lot
+                max_end, max_end_id = datetime.date.min, None
+                ids_end, ids_end_id = datetime.date.min, None
+            if line_id in ids:
+                if start_date < max_end:
+                    return max_end_id, line_id
+                if end_date > ids_end:
+                    ids_end, ids_end_id = end_date, line_id
+            elif start_date < ids_end:
+                return ids_end_id, line_id
+            if end_date > max_end:
+                max_end, max_end_id = end_date, line_id
@@ -1,11 +1,13 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
+import datetime
 import unittest
 
 import doctest
 
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import suite as test_suite
 from trytond.tests.test_tryton import doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
@@ -15,6 +17,121 @@ class SaleSubscriptionAssetTestCase(ModuleTestCase):
     'Test Sale Subscription Asset module'
     module = 'sale_subscription_asset'
 
+    def assertOverlapping(self, rows, ids, overlapping):
+        pool = Pool()
+        Line = pool.get('sale.subscription.line')
+        rows = [(id_, lot, datetime.date(*start),
+                datetime.date(*end) if end else None)
+            for id_, lot, start, end in rows]
+        self.assertEqual(
+            Line._sweep_overlapping_dates(rows, ids), overlapping)
+
+    @with_transaction()
+    def test_sweep_overlapping_dates_touching(self):
+        "Test sweep overlapping dates with touching lines"
+        self.assertOverlapping([
+                (1, 1, (2017, 1, 1), (2017, 1, 31)),
+                (2, 1, (2017, 1, 31), (2017, 3, 1)),
+                ], {1, 2}, None)
+
+    @with_transaction()
+    def test_sweep_overlapping_dates_overlapping(self):
+        "Test sweep overlapping dates with overlapping lines"
+        self.assertOverlapping([
+                (1, 1, (2017, 1, 1), (2017, 1, 31)),
+                (2, 1, (2017, 1, 30), (2017, 3, 1)),
+                ], {2}, (1, 2))
+
+    @with_transaction()
+    def test_sweep_overlapping_dates_other_lot(self):
+        "Test sweep overlapping dates with lines of different lots"
+        self.assertOverlapping([
+                (1, 1, (2017, 1, 1), None),
+                (2, 2, (2017, 1, 1), None),
+                ], {1, 2}, None)
+
+    @with_transaction()
+    def test_sweep_overlapping_dates_zero_length(self):
+        "Test sweep overlapping dates with zero-length line"
+        self.assertOverlapping([
+                (1, 1, (2017, 1, 1), None),
+                (2, 1, (2017, 2, 1), (2017, 2, 1)),
+                ], {1, 2}, None)
+
+    @with_transaction()
+    def test_sweep_overlapping_dates_open_end(self):
+        "Test sweep overlapping dates with open end dates"
+        self.assertOverlapping([
+                (1, 1, (2017, 1, 1), None),
+                (2, 1, (2018, 1, 1), (2018, 2, 1)),
+                ], {2}, (1, 2))
+        self.assertOverlapping([
+                (1, 1, (2017, 1, 1), (2017, 2, 1)),
+                (2, 1, (2017, 1, 15), None),
+                ], {1}, (1, 2))
+        self.assertOverlapping([
+                (1, 1, (2017, 1, 1), (2017, 2, 1)),
+                (2, 1, (2017, 2, 1), None),
+                ], {1, 2}, None)
+
+    @with_transaction()
+    def test_sweep_overlapping_dates_same_start(self):
+        "Test sweep overlapping dates with same start dates"
+        self.assertOverlapping([
+                (1, 1, (2017, 1, 1), (2017, 1, 31)),
+                (2, 1, (2017, 1, 1), (2017, 2, 1)),
+                ], {2}, (1, 2))
+
+    @with_transaction()
+    def test_sweep_overlapping_dates_not_validated(self):
+        "Test sweep overlapping dates ignores pairs without validated line"
+        rows = [
+            (1, 1, (2017, 1, 1), (2017, 12, 31)),
+            (2, 1, (2017, 2, 1), (2017, 3, 1)),
+            (3, 1, (2018, 1, 1), None),
+            ]
+        self.assertOverlapping(rows, {3}, None)
+        self.assertOverlapping(rows, {2}, (1, 2))
+
+    @with_transaction()
+    def test_sweep_overlapping_dates_not_consecutive(self):
+        "Test sweep overlapping dates with not consecutive lines"
+        rows = [
+            (1, 1, (2017, 1, 1), (2017, 1, 10)),
+            (2, 1, (2017, 1, 2), (2017, 1, 3)),
+            (3, 1, (2017, 1, 5), (2017, 1, 8)),
+            ]
+        self.assertOverlapping(rows, {3}, (1, 3))
+        self.assertOverlapping(rows, {1}, (1, 2))
+
+    @with_transaction()
+    def test_consumption_rruleset_cache(self):
+        "Test consumption rruleset is rebuilt after a write"
+        pool = Pool()
+        RuleSet = pool.get('sale.subscription.recurrence.rule.set')
+        Line = pool.get('sale.subscription.line')
+
+        monthly, = RuleSet.create([{
+                    'name': "Monthly",
+                    'rules': [('create', [{
+                                    'freq': 'monthly',
+                                    'interval': 1,
+                                    }])],
+                    }])
+        line = Line(
+            consumption_recurrence=monthly,
+            start_date=datetime.date(2018, 1, 1))
+
+        rruleset = line._get_consumption_rruleset()
+        self.assertIs(line._get_consumption_rruleset(), rruleset)
+
+        RuleSet.write([monthly], {
+                'rules': [('write', [r.id for r in monthly.rules], {
+                            'interval': 2,
+                            })],
+                })
+        self.assertIsNot(line._get_consumption_rruleset(), rruleset)
+
 
 def suite():
     suite = test_suite()